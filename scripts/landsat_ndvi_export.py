@@ -3,8 +3,9 @@
 """
 landsat_ndvi_export.py
 ----------------------
-A robust script to generate NDVI composites (median) for multiple Landsat collections
-across a range of years, apply cloud masking, and export to Google Drive.
+A robust script to generate NDVI composites (greenest pixel) for multiple Landsat collections
+across a range of years, apply cloud masking, and download them as local GeoTIFFs
+(or export to Google Drive for large AOIs).
 
 Usage:
   1) Activate your Python environment (venv).
@@ -12,19 +13,52 @@ Usage:
   3) Run: python scripts/landsat_ndvi_export.py
 """
 
+import os
 import ee
 import sys
+import time
+import random
+import requests
+from functools import lru_cache, reduce
+import rasterio
+from rasterio.merge import merge
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ------------------------ USER CONFIGURATIONS ------------------------
 
+# Earth Engine Cloud project (set EE_PROJECT or edit here).
+EE_PROJECT = os.environ.get('EE_PROJECT')
+
+# Earth Engine API endpoint. The high-volume endpoint is sized for parallel
+# programmatic requests; set EE_ENDPOINT=standard for interactive debugging.
+EE_HIGH_VOLUME_URL = 'https://earthengine-highvolume.googleapis.com'
+EE_STANDARD_URL = 'https://earthengine.googleapis.com'
+EE_URL = EE_STANDARD_URL if os.environ.get('EE_ENDPOINT') == 'standard' else EE_HIGH_VOLUME_URL
+
 # Years to analyze: here, every 5 years from 1985 to 2020 (inclusive).
 START_YEARS = list(range(1985, 2021, 5))
 
+# Months (inclusive) composited each year. May - September covers the growing
+# season when NDVI is most informative; use (1, 12) for the full calendar year.
+SEASON_MONTHS = (5, 9)
+
 # Region of interest (Albemarle Peninsula approx. bounding box).
-# You can refine this or replace with your own AOI geometry.
-REGION = ee.Geometry.Rectangle([-76.5, 35.5, -75.5, 36.5])
+# You can refine this or replace get_region() with your own AOI geometry.
+REGION_BOUNDS = [-76.5, 35.5, -75.5, 36.5]
+
+# Export mode: 'download' fetches each composite directly with getDownloadURL,
+# which suits small AOIs like this one; 'drive' queues Drive export tasks for
+# AOIs beyond the direct-download size limit.
+EXPORT_MODE = os.environ.get('EXPORT_MODE', 'download')
 
-# Output folder in your Google Drive (must exist or GEE will create it).
+# Local folder for downloaded GeoTIFFs ('download' mode).
+OUTPUT_DIR = 'outputs'
+
+# The AOI is split into a DOWNLOAD_TILES x DOWNLOAD_TILES grid so each
+# getDownloadURL request stays under Earth Engine's request size limit.
+DOWNLOAD_TILES = 2
+
+# Output folder in your Google Drive ('drive' mode; GEE creates it if missing).
 DRIVE_FOLDER = 'GEE_Exports'
 
 # Desired projection scale (meters). Landsat ~30m resolution.
@@ -33,6 +67,30 @@ SCALE = 30
 # CRS
 CRS = 'EPSG:4326'
 
+# Maximum scene-level cloud cover (%) kept before per-pixel cloud masking.
+MAX_CLOUD_COVER = 70
+
+# Number of years submitted to Earth Engine concurrently.
+MAX_WORKERS = 8
+
+# Attempts per Earth Engine / download request before giving up. Delays grow
+# exponentially (1s, 2s, 4s, ...) with jitter.
+MAX_RETRIES = 6
+
+# Earth Engine's per-user task queue limit, and how often (seconds) to poll
+# the queue while it is full.
+TASK_QUEUE_LIMIT = 3000
+QUEUE_POLL_SECONDS = 60
+
+# How often (seconds) to poll submitted Drive exports, and how many times an
+# export that fails with a transient error is submitted in total.
+TASK_POLL_SECONDS = 60
+MAX_TASK_ATTEMPTS = 3
+
+# google.rpc error codes worth resubmitting: DEADLINE_EXCEEDED,
+# RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE.
+TRANSIENT_ERROR_CODES = {4, 8, 10, 13, 14}
+
 # Landsat Collections (Tier 1, Surface Reflectance). 
 # Using older collections for historical coverage:
 LANDSAT_COLLECTIONS = {
@@ -43,115 +101,302 @@ LANDSAT_COLLECTIONS = {
 
 # Define sensor-specific band names
 SENSOR_BANDS = {
-    'LANDSAT_5': {'nir': 'SR_B4', 'red': 'SR_B3', 'qa': 'QA_PIXEL'},
-    'LANDSAT_7': {'nir': 'SR_B4', 'red': 'SR_B3', 'qa': 'QA_PIXEL'},
-    'LANDSAT_8': {'nir': 'SR_B5', 'red': 'SR_B4', 'qa': 'QA_PIXEL'},
+    'LANDSAT_5': {'nir': 'SR_B4', 'red': 'SR_B3'},
+    'LANDSAT_7': {'nir': 'SR_B4', 'red': 'SR_B3'},
+    'LANDSAT_8': {'nir': 'SR_B5', 'red': 'SR_B4'},
 }
 
+# QA_PIXEL bits 3 = cloud shadow, 5 = cloud
+CLOUD_BIT_MASK = (1 << 3) | (1 << 5)
+
 # -------------------------------------------------------------
 
-def mask_clouds(image, sensor_key):
+@lru_cache(maxsize=None)
+def get_region():
+    """
+    Build the region of interest on first use, so importing this module
+    does not require an initialized Earth Engine session.
+    """
+    return ee.Geometry.Rectangle(REGION_BOUNDS)
+
+def mask_clouds(image):
     """
-    Mask clouds and shadows using the QA_PIXEL band.
+    Mask clouds and shadows using the QA_PIXEL band, whose bit layout is shared
+    by Landsat 5/7/8 in Collection 2.
     Adjust bitwise logic if needed for different sensors or GEE versions.
     """
-    qa = image.select(SENSOR_BANDS[sensor_key]['qa'])
+    qa = image.select('QA_PIXEL')
     
-    # Bits 3 = cloud shadow, 5 = cloud
-    cloud_shadow_bit_mask = 1 << 3
-    clouds_bit_mask = 1 << 5
-    
-    mask = qa.bitwiseAnd(cloud_shadow_bit_mask).eq(0).And(
-           qa.bitwiseAnd(clouds_bit_mask).eq(0))
+    # Both bits must be clear, so test them with a single bitwise AND.
+    mask = qa.bitwiseAnd(CLOUD_BIT_MASK).eq(0)
     return image.updateMask(mask)
 
-def add_ndvi(image, sensor_key):
+def add_ndvi(image):
     """
-    Calculate NDVI using the sensor-specific RED and NIR bands.
+    Calculate NDVI from the harmonized NIR and RED bands.
     NDVI = (NIR - RED) / (NIR + RED)
     """
-    nir_band = SENSOR_BANDS[sensor_key]['nir']
-    red_band = SENSOR_BANDS[sensor_key]['red']
-    ndvi = image.normalizedDifference([nir_band, red_band]).rename('NDVI')
-    return image.addBands(ndvi)
+    return image.normalizedDifference(['NIR', 'RED']).rename('NDVI')
 
 def get_landsat_collection(sensor_key, start_date, end_date):
     """
-    Fetch, cloud-mask, and add NDVI for the specified sensor (L5, L7, or L8)
-    within the given date range.
+    Fetch the specified sensor (L5, L7, or L8) over scenes intersecting the
+    region within the given date range. Images are clipped to the region and
+    reduced to sensor-agnostic NIR, RED, and QA_PIXEL bands so cloud masking
+    and NDVI run once after merging in combine_collections.
     """
     collection_id = LANDSAT_COLLECTIONS[sensor_key]
+    
+    # Resolve band names once so the mapped function closes over plain strings.
+    bands = SENSOR_BANDS[sensor_key]
+    source_bands = [bands['nir'], bands['red'], 'QA_PIXEL']
+    region = get_region()
+    
+    def harmonize(img):
+        # Single per-image pass: rename to common bands and clip to the AOI.
+        return img.select(source_bands, ['NIR', 'RED', 'QA_PIXEL']).clip(region)
+    
     try:
         collection = (ee.ImageCollection(collection_id)
+                      .filterBounds(region)
                       .filterDate(start_date, end_date)
-                      .map(lambda img: mask_clouds(img, sensor_key))
-                      .map(lambda img: add_ndvi(img, sensor_key))
+                      .filter(ee.Filter.lt('CLOUD_COVER', MAX_CLOUD_COVER))
+                      .map(harmonize)
                      )
         return collection
     except Exception as e:
         print(f"Error fetching collection {sensor_key} for dates {start_date} to {end_date}: {e}")
         return ee.ImageCollection([])
 
-def combine_collections(start_date, end_date):
+def combine_collections(start_date, end_date, sensors):
+    """
+    Combine the collections of the given sensors for the date range,
+    as some years might have multiple sensors operational, then cloud-mask
+    and compute NDVI over the merged collection in a single pass.
+    """
+    sensor_colls = [get_landsat_collection(sensor_key, start_date, end_date)
+                    for sensor_key in sensors]
+    combined = reduce(lambda a, b: a.merge(b), sensor_colls)
+    return combined.map(lambda img: add_ndvi(mask_clouds(img)))
+
+def queued_task_count():
+    """
+    Count this account's Earth Engine operations that are pending or running.
+    """
+    operations = ee.data.listOperations()
+    return sum(1 for op in operations
+               if op.get('metadata', {}).get('state') in ('PENDING', 'RUNNING'))
+
+def with_retries(func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs), retrying transient Earth Engine and HTTP errors
+    with exponential backoff. If the task queue is full, wait for it to drain
+    before the next attempt.
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            return func(*args, **kwargs)
+        except (ee.ee_exception.EEException, requests.RequestException) as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            
+            if 'Too many tasks' in str(e):
+                while True:
+                    queued = queued_task_count()
+                    if queued < TASK_QUEUE_LIMIT:
+                        break
+                    print(f"Task queue is full ({queued} tasks). Waiting {QUEUE_POLL_SECONDS}s...")
+                    time.sleep(QUEUE_POLL_SECONDS)
+            
+            delay = 2 ** attempt + random.random()
+            print(f"Request failed ({e}). Retrying in {delay:.1f}s "
+                  f"(attempt {attempt + 2} of {MAX_RETRIES}).")
+            time.sleep(delay)
+
+def fetch_url(url):
+    """
+    GET url and return the response body, raising on HTTP errors.
+    """
+    response = requests.get(url, timeout=300)
+    response.raise_for_status()
+    return response.content
+
+def region_tiles():
+    """
+    Split REGION_BOUNDS into a DOWNLOAD_TILES x DOWNLOAD_TILES grid of
+    rectangles for chunked downloads.
+    """
+    west, south, east, north = REGION_BOUNDS
+    step_x = (east - west) / DOWNLOAD_TILES
+    step_y = (north - south) / DOWNLOAD_TILES
+    return [ee.Geometry.Rectangle([west + i * step_x, south + j * step_y,
+                                   west + (i + 1) * step_x, south + (j + 1) * step_y])
+            for i in range(DOWNLOAD_TILES) for j in range(DOWNLOAD_TILES)]
+
+def download_composite(image, file_prefix):
     """
-    Combine L5, L7, and L8 collections for the date range,
-    as some years might have multiple sensors operational.
+    Download the composite tile by tile via getDownloadURL and stitch the
+    tiles into a single GeoTIFF at OUTPUT_DIR/<file_prefix>.tif.
     """
-    combined = ee.ImageCollection([])
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
     
-    for sensor_key in LANDSAT_COLLECTIONS.keys():
-        sensor_coll = get_landsat_collection(sensor_key, start_date, end_date)
-        combined = combined.merge(sensor_coll)
+    tile_paths = []
+    for i, tile in enumerate(region_tiles()):
+        url = with_retries(image.getDownloadURL, {
+            'name': f"{file_prefix}_{i}",
+            'bands': ['NDVI'],
+            'region': tile,
+            'scale': SCALE,
+            'crs': CRS,
+            'format': 'GEO_TIFF',
+        })
+        content = with_retries(fetch_url, url)
+        
+        tile_path = os.path.join(OUTPUT_DIR, f"{file_prefix}_{i}.tif")
+        with open(tile_path, 'wb') as f:
+            f.write(content)
+        tile_paths.append(tile_path)
+    
+    # Stitch tiles into one raster and remove the intermediate files
+    sources = [rasterio.open(path) for path in tile_paths]
+    try:
+        mosaic, transform = merge(sources)
+        profile = sources[0].profile
+    finally:
+        for src in sources:
+            src.close()
+    profile.update(height=mosaic.shape[1], width=mosaic.shape[2], transform=transform)
+    
+    output_path = os.path.join(OUTPUT_DIR, f"{file_prefix}.tif")
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        dst.write(mosaic)
     
-    return combined
+    for path in tile_paths:
+        os.remove(path)
+    
+    return output_path
 
-def export_ndvi(year):
+def export_ndvi(year, sensors, task_id=None):
     """
-    For a given year, build a date range, fetch and combine sensor data,
-    create a median NDVI image, and export to Google Drive.
+    For a given year, build the season's date range, fetch and combine data
+    from the operational sensors, create a greenest-pixel NDVI composite, and
+    export it, either by direct download or to Google Drive under the
+    pre-generated task_id (see EXPORT_MODE). Returns the Earth Engine task ID
+    of a submitted Drive export, otherwise None.
     """
-    # Build date range for the entire year
-    start_date = f"{year}-01-01"
-    end_date   = f"{year}-12-31"
+    # Build the season's date range (filterDate's end date is exclusive)
+    first_month, last_month = SEASON_MONTHS
+    end_year, end_month = (year + 1, 1) if last_month == 12 else (year, last_month + 1)
+    start_date = f"{year}-{first_month:02d}-01"
+    end_date   = f"{end_year}-{end_month:02d}-01"
     
     print(f"Processing year: {year}")
     
-    collection = combine_collections(start_date, end_date)
+    collection = combine_collections(start_date, end_date, sensors)
     
-    # Check if collection is empty
-    if collection.size().getInfo() == 0:
-        print(f"No images found for year {year}. Skipping export.")
-        return
+    # Create greenest-pixel composite focusing on NDVI band. qualityMosaic is a
+    # single pass per pixel, unlike median which sorts every observation.
+    # The empty-collection check runs server-side so building the export needs
+    # no blocking round trip; years without imagery export a fully masked band.
+    empty_image = ee.Image.constant(0).rename('NDVI').updateMask(0)
+    composite = ee.Image(ee.Algorithms.If(
+        collection.size().gt(0),
+        collection.qualityMosaic('NDVI'),
+        empty_image))
     
-    # Create median composite focusing on NDVI band
-    median_image = collection.median().select(['NDVI'])
+    file_prefix = f"NDVI_{year}_Albemarle"
     
-    # Clip to region
-    composite_clipped = median_image.clip(REGION)
+    if EXPORT_MODE != 'drive':
+        try:
+            output_path = download_composite(composite, file_prefix)
+            print(f"Downloaded NDVI composite for year {year} to {output_path}.")
+        except Exception as e:
+            print(f"Failed to download NDVI composite for year {year}: {e}")
+        return
     
     # Prepare export task
-    file_prefix = f"NDVI_{year}_Albemarle"
     task = ee.batch.Export.image.toDrive(
-        image=composite_clipped,
+        image=composite,
         description=file_prefix,
         folder=DRIVE_FOLDER,
         fileNamePrefix=file_prefix,
-        region=REGION.toGeoJSON()['coordinates'],
+        region=get_region(),
         scale=SCALE,
         crs=CRS,
         maxPixels=1e13  # Increase if dealing w/ large areas
     )
     
+    # Submit directly with the pre-generated ID; task.start() would request
+    # a new ID from the server for every year. Reusing the ID makes retries
+    # idempotent.
     try:
-        task.start()
+        operation = with_retries(ee.data.exportImage, task_id, task.config)
         print(f"Export to Google Drive started for year {year}.")
+        return operation['name'].rsplit('/', 1)[-1]
     except Exception as e:
         print(f"Failed to start export for year {year}: {e}")
 
+def monitor_tasks(submitted):
+    """
+    Poll Earth Engine until every submitted Drive export (task ID -> (year,
+    sensors)) has finished, printing a progress line per poll. Exports that
+    fail with a transient error are resubmitted under fresh task IDs, up to
+    MAX_TASK_ATTEMPTS submissions per year.
+    """
+    total = len(submitted)
+    pending = dict(submitted)
+    attempts = {task_id: 1 for task_id in submitted}
+    succeeded = failed = 0
+    
+    while pending:
+        time.sleep(TASK_POLL_SECONDS)
+        
+        operations = {op['name'].rsplit('/', 1)[-1]: op
+                      for op in with_retries(ee.data.listOperations)}
+        
+        running = 0
+        to_resubmit = []
+        for task_id in list(pending):
+            op = operations.get(task_id)
+            state = op.get('metadata', {}).get('state') if op else None
+            
+            if state == 'SUCCEEDED':
+                pending.pop(task_id)
+                succeeded += 1
+            elif state in ('FAILED', 'CANCELLED'):
+                year, sensors = pending.pop(task_id)
+                error = op.get('error', {})
+                if (error.get('code') in TRANSIENT_ERROR_CODES
+                        and attempts[task_id] < MAX_TASK_ATTEMPTS):
+                    print(f"Export for year {year} failed ({error.get('message')}). Resubmitting.")
+                    to_resubmit.append((year, sensors, attempts[task_id] + 1))
+                else:
+                    print(f"Export for year {year} {state.lower()}: {error.get('message', 'no details')}")
+                    failed += 1
+            elif state == 'RUNNING':
+                running += 1
+        
+        if to_resubmit:
+            new_ids = with_retries(ee.data.newTaskId, len(to_resubmit))
+            for (year, sensors, attempt), new_id in zip(to_resubmit, new_ids):
+                task_id = export_ndvi(year, sensors, new_id)
+                if task_id:
+                    pending[task_id] = (year, sensors)
+                    attempts[task_id] = attempt
+                else:
+                    failed += 1
+        
+        print(f"Tasks: {succeeded}/{total} succeeded, {running} running, "
+              f"{len(pending) - running} queued, {failed} failed")
+    
+    return succeeded, failed
+
 def main():
     print("Starting NDVI export script...")
     
-    # Loop through specified years
+    ee.Initialize(project=EE_PROJECT, opt_url=EE_URL)
+    
+    years = []
     for y in START_YEARS:
         # Handle pre-1984 data (only L5 available)
         if y < 1984:
@@ -159,16 +404,41 @@ def main():
             continue
         
         # Handle data availability based on sensor timelines
-        if y <= 2012:
+        if y < 1999:
             sensors = ['LANDSAT_5']
-        elif y <= 2013:
+        elif y <= 2012:
             sensors = ['LANDSAT_5', 'LANDSAT_7']
         else:
             sensors = ['LANDSAT_7', 'LANDSAT_8']
         
-        export_ndvi(y)
+        years.append((y, sensors))
+    
+    # Reserve all Drive export task IDs in a single request.
+    if EXPORT_MODE == 'drive':
+        task_ids = with_retries(ee.data.newTaskId, len(years))
+    else:
+        task_ids = [None] * len(years)
+    
+    # Submit years concurrently; each export is bound by Earth Engine RPC latency.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(export_ndvi, y, sensors, task_id): (y, sensors)
+                   for (y, sensors), task_id in zip(years, task_ids)}
+        submitted = {}
+        for future in as_completed(futures):
+            try:
+                task_id = future.result()
+            except ee.ee_exception.EEException as e:
+                print(f"Earth Engine error while processing year {futures[future][0]}: {e}")
+                continue
+            if task_id:
+                submitted[task_id] = futures[future]
     
-    print("All exports have been triggered. Check your GEE Tasks panel or monitor logs.")
+    if EXPORT_MODE == 'drive':
+        print("All exports have been triggered. Monitoring task status...")
+        succeeded, failed = monitor_tasks(submitted)
+        print(f"Exports finished: {succeeded} succeeded, {failed} failed.")
+    else:
+        print(f"All downloads have finished. GeoTIFFs are in '{OUTPUT_DIR}'.")
 
 if __name__ == "__main__":
     try: